@@ -2,7 +2,20 @@ import pandas as pd
 import numpy as np
 import logging
 import os
-from concurrent.futures import ProcessPoolExecutor
+import pyarrow as pa
+import pyarrow.csv as pv
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:  # Fall back to the vectorized NumPy implementation
+    NUMBA_AVAILABLE = False
+
+try:
+    import numexpr as ne
+    NUMEXPR_AVAILABLE = True
+except ImportError:  # Fall back to plain NumPy expressions
+    NUMEXPR_AVAILABLE = False
 
 
 # Configure logging
@@ -11,139 +24,308 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(
 # Configuration Variables
 data_path = ""  # Adjust if needed
 simulations = 100  # Number of Monte Carlo runs per day
+seed = None  # Random seed for reproducible runs (None draws fresh entropy)
 output_path = ""  # Ensure write permissions
+market_open = 9 * 60  # 09:00 as minutes after midnight
+market_close = 17 * 60 + 29  # 17:29 as minutes after midnight
 
 def load_and_preprocess_data(file_path):
     """
     Loads and preprocesses stock data:
-    - Converts timestamps
+    - Reads only timestamps and prices with the multithreaded PyArrow parser
+    - Parses timestamps and stores prices as float32 while reading
+    - Drops rows with missing or unparseable timestamps
     - Sorts chronologically
-    - Filters trading hours 09:00-17:29
+    - Adds minutes after midnight, used by split_by_day to trim trading hours 09:00-17:29
+    - Caches the result as Parquet next to the CSV; reused while newer than the CSV
     """
+    cache_path = file_path + '.parquet'
+
+    # The cache is only an optimisation; an unreadable or stale-layout cache falls back to the CSV
     try:
-        df = pd.read_csv(file_path)
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
-        df = df.sort_values(by='timestamp')
+        if os.path.isfile(cache_path) and os.path.getmtime(cache_path) > os.path.getmtime(file_path):
+            df = pd.read_parquet(cache_path)
+            if is_valid_cache(df):
+                return df
+            logging.warning(f"Ignoring cache {cache_path} with unexpected layout")
+    except Exception as e:
+        logging.warning(f"Could not read cache {cache_path}: {e}")
 
-        # Filter market hours (09:00 to 17:29)
-        df_filtered = df[(df['timestamp'].dt.strftime('%H:%M') >= '09:00') & 
-                         (df['timestamp'].dt.strftime('%H:%M') <= '17:29')]
+    try:
+        df = pd.read_csv(file_path, engine='pyarrow', usecols=['timestamp', 'price'],
+                         dtype={'price': 'float32'}, parse_dates=['timestamp'])
+        df = df.dropna(subset=['timestamp'])
+        df = df.sort_values(by='timestamp')
 
-        return df_filtered
+        # Minutes after midnight in a single pass over the datetime64 buffer
+        minutes = df['timestamp'].values.astype('datetime64[m]').astype(np.int64) % 1440
+        df['minutes'] = minutes.astype(np.int16)
 
     except Exception as e:
         logging.error(f"Error loading file {file_path}: {e}")
         return None
 
-def extract_sod_eod(df):
+    # Write to a temporary file and move it into place, so an interrupted write
+    # never leaves a truncated cache; a failed write must not fail the load
+    tmp_path = f"{file_path}.{os.getpid()}.tmp.parquet"
+    try:
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        logging.warning(f"Could not write cache {cache_path}: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+    return df
+
+def is_valid_cache(df):
     """
-    Extracts Start-of-Day (SOD) and End-of-Day (EOD) prices for each trading day.
-    Handles missing timestamps by interpolating from nearby values.
+    Checks that a cached frame has the layout written by load_and_preprocess_data.
     """
-    sod_eod = {}
-    df['date'] = df['timestamp'].dt.date
-    grouped_data = df.groupby('date')
+    return (list(df.columns) == ['timestamp', 'price', 'minutes']
+            and df['timestamp'].dtype.kind == 'M'
+            and df['price'].dtype == np.float32
+            and df['minutes'].dtype == np.int16
+            and not df['timestamp'].isna().any())
 
-    for date, data in grouped_data:
-        sod_row = data[data['timestamp'].dt.strftime('%H:%M') == '09:00']
-        eod_row = data[data['timestamp'].dt.strftime('%H:%M') == '17:29']
+def split_by_day(df):
+    """
+    Splits chronologically sorted data into trading days without groupby:
+    - Sorted timestamps give a monotonic key day * 1440 + minutes after midnight.
+    - Market hours (09:00 to 17:29) of each day are located with searchsorted on that key.
+    - EOD is the first price at 17:29, or the last market-hours price when 17:29 is missing.
+    - Returns the day dates, per-day price arrays and EOD prices, skipping days without
+      market-hours prices.
+    """
+    if len(df) == 0:
+        return np.array([], dtype='datetime64[D]'), [], np.empty(0, dtype=np.float32)
 
-        if sod_row.empty:
-            sod = data.iloc[0]['price']  # Use first available price
-        else:
-            sod = sod_row.iloc[0]['price']
+    day_ids = df['timestamp'].values.astype('datetime64[D]').view('i8')
+    keys = day_ids * 1440 + df['minutes'].values
 
-        if eod_row.empty:
-            eod = data.iloc[-1]['price']  # Use last available price
-        else:
-            eod = eod_row.iloc[0]['price']
+    calendar_days = np.arange(day_ids[0], day_ids[-1] + 1)
+    starts = np.searchsorted(keys, calendar_days * 1440 + market_open, side='left')
+    closes = np.searchsorted(keys, calendar_days * 1440 + market_close, side='left')
+    ends = np.searchsorted(keys, calendar_days * 1440 + market_close, side='right')
+    trading = ends > starts
 
-        sod_eod[date] = (sod, eod)
+    unique_days = calendar_days[trading].astype('datetime64[D]')
+    prices = df['price'].values
+    price_chunks = [prices[start:end] for start, end in zip(starts[trading], ends[trading])]
+    eod = prices[np.where(closes < ends, closes, ends - 1)[trading]]
 
-    return sod_eod
+    return unique_days, price_chunks, eod
 
-def calculate_realized_volatility(prices, sod, eod):
+def pad_days(price_chunks, eod):
     """
-    Computes the realized volatility using:
-    - Random selection of 5 intraday prices (chronologically sorted).
-    - Calculation of log returns.
-    - RMS of log returns to compute realized volatility.
+    Packs per-day price arrays into one padded float32 matrix for the all-days simulations.
+    Returns the (n_days, max_len) price matrix, the day lengths and the SOD/EOD vectors.
+    SOD is the first price of each day; EOD is passed through from split_by_day.
     """
-    prices = np.array(prices)
-
-    if len(prices) < 6:  # Need at least 6 points (SOD + 5 intraday + EOD)
-        return None
+    lengths = np.array([len(chunk) for chunk in price_chunks], dtype=np.int64)
+    prices = np.zeros((len(price_chunks), lengths.max()), dtype=np.float32)
 
-    # Select 5 **unique** random indices within valid intraday range
-    random_indices = np.sort(np.random.choice(len(prices) - 2, size=5, replace=False) + 1)
-    selected_prices = prices[random_indices]
+    for d, chunk in enumerate(price_chunks):
+        prices[d, :len(chunk)] = chunk
 
-    p1, p2, p3, p4, p5 = selected_prices
+    sod = prices[:, 0].copy()
+    eod = np.asarray(eod, dtype=np.float32)
 
-    # Compute log returns
-    log_returns = np.log([p1 / sod, p2 / p1, p3 / p2, p4 / p3, p5 / p4, eod / p5])
+    return prices, lengths, sod, eod
 
-    # Compute realized volatility (annualized)
-    return np.sqrt(np.mean(log_returns ** 2)) * 16
-
-def monte_carlo_day(date, prices, sod, eod, num_simulations):
+def floyd_sample(n, k, size, rng):
     """
-    Runs Monte Carlo simulations for a single day.
-    Returns a tuple (date, realized_volatility).
+    Draws `k` unique indices from range(n) for every entry of an array of shape `size`
+    using Floyd's algorithm, vectorized across entries.
+    `n` may be an array broadcastable to `size`, e.g. one population size per day.
+    Costs O(k) random draws per entry regardless of `n`.
+    Returns an array of shape size + (k,) sorted along the last axis.
     """
-    volatilities = [
-        calculate_realized_volatility(prices, sod, eod)
-        for _ in range(num_simulations)
-    ]
+    size = tuple(np.atleast_1d(size))
+    n = np.broadcast_to(n, size)
+    samples = np.empty(size + (k,), dtype=np.int64)
+
+    for col in range(k):
+        j = n - k + col
+        t = rng.integers(0, j + 1, size=size)
+        # On collision Floyd's algorithm takes j, which cannot have been drawn yet
+        collision = (samples[..., :col] == t[..., None]).any(axis=-1)
+        samples[..., col] = np.where(collision, j, t)
 
-    volatilities = [v for v in volatilities if v is not None]
+    return np.sort(samples, axis=-1)
 
-    if volatilities:
-        rms_volatility = np.sqrt(np.mean(np.square(volatilities)))
-        return date, rms_volatility
-    return date, None
+def calculate_log_returns(prices):
+    """
+    Computes log returns along the last axis of a price array or price paths.
+    Works in float64 so differencing the logs does not lose float32 precision.
+    """
+    return np.diff(np.log(np.asarray(prices, dtype=np.float64)), axis=-1)
 
-def monte_carlo_simulation(df, sod_eod, num_simulations=simulations):
+def calculate_realized_volatility_all_days(prices, lengths, sod, eod, n_sims, rng):
+    """
+    Computes the realized volatility of all days at once from the padded price matrix:
+    - Random indices for every day and simulation are drawn as one (n_days, n_sims, 5) tensor.
+    - Log returns of all price paths come from a single (n_days, n_sims, 6) computation.
+    - RMS of log returns per simulation, then RMS across simulations. Both RMS
+      steps collapse into one mean of the per-simulation sums of squares.
+    - Days with fewer than 7 points (SOD + 5 intraday + EOD) are set to NaN.
+    """
+    volatilities = np.full(len(lengths), np.nan)
+    valid = lengths >= 7
+
+    if not valid.any():
+        return volatilities
+
+    prices, lengths, sod, eod = prices[valid], lengths[valid], sod[valid], eod[valid]
+    n_days = len(lengths)
+
+    # Select 5 **unique** random indices per day and simulation within valid intraday range
+    random_indices = floyd_sample((lengths - 2)[:, None], 5, (n_days, n_sims), rng) + 1
+    selected_prices = np.take_along_axis(prices[:, None, :], random_indices, axis=2)
+
+    # Price paths of shape (n_days, n_sims, 7): SOD, p1..p5, EOD
+    paths = np.concatenate([np.broadcast_to(sod[:, None, None], (n_days, n_sims, 1)), selected_prices,
+                            np.broadcast_to(eod[:, None, None], (n_days, n_sims, 1))], axis=2)
+
+    # Compute log returns and their sum of squares for every day and simulation
+    if NUMEXPR_AVAILABLE:
+        # Fused into one pass without (n_days, n_sims, 6) intermediates
+        sumsq = ne.evaluate('sum(log(hi / lo) ** 2, axis=2)',
+                            local_dict={'hi': paths[:, :, 1:], 'lo': paths[:, :, :-1]})
+    else:
+        log_returns = calculate_log_returns(paths)
+        sumsq = (log_returns * log_returns).sum(axis=2)
+
+    # sqrt(mean((sqrt(sumsq / 6) * 16) ** 2)) == sqrt(mean(sumsq) / 6) * 16
+    # Promote to float64 for the final reduction across simulations
+    volatilities[valid] = np.sqrt(sumsq.astype(np.float64).mean(axis=1) * (1.0 / 6.0)) * 16.0
+
+    return volatilities
+
+if NUMBA_AVAILABLE:
+    @njit(fastmath=True, cache=True)
+    def mc_day_kernel(prices, sod, eod, n_sims):
+        """
+        Numba kernel running all Monte Carlo simulations of a single day:
+        - Floyd sampling of 5 unique intraday indices, insertion-sorted.
+        - Fixed 6-return shape written as straight-line float32 code per simulation.
+        """
+        n = len(prices) - 2
+        sumsqs = np.empty(n_sims, dtype=np.float32)
+
+        for s in range(n_sims):
+            indices = np.empty(5, dtype=np.int64)
+
+            # Floyd's algorithm: 5 unique indices from range(n)
+            for col in range(5):
+                j = n - 5 + col
+                t = np.random.randint(0, j + 1)
+                for c in range(col):
+                    if indices[c] == t:
+                        t = j
+                        break
+                indices[col] = t
+
+            # Insertion sort to restore chronological order
+            for a in range(1, 5):
+                value = indices[a]
+                b = a - 1
+                while b >= 0 and indices[b] > value:
+                    indices[b + 1] = indices[b]
+                    b -= 1
+                indices[b + 1] = value
+
+            # Sum of squared log returns along SOD -> p1..p5 -> EOD, fully unrolled
+            p1 = prices[indices[0] + 1]
+            p2 = prices[indices[1] + 1]
+            p3 = prices[indices[2] + 1]
+            p4 = prices[indices[3] + 1]
+            p5 = prices[indices[4] + 1]
+
+            l1 = np.log(p1 / sod)
+            l2 = np.log(p2 / p1)
+            l3 = np.log(p3 / p2)
+            l4 = np.log(p4 / p3)
+            l5 = np.log(p5 / p4)
+            l6 = np.log(eod / p5)
+
+            sumsqs[s] = l1 * l1 + l2 * l2 + l3 * l3 + l4 * l4 + l5 * l5 + l6 * l6
+
+        # RMS across simulations of the annualized volatilities in one reduction
+        return np.sqrt(np.mean(sumsqs.astype(np.float64)) * (1.0 / 6.0)) * 16.0
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def mc_all_days(prices, lengths, sod, eod, n_sims, base_seed, out):
+        """
+        Numba driver running the Monte Carlo simulations of all days:
+        - Days are distributed across threads with prange over the padded price matrix.
+        - Each day seeds its thread's generator with base_seed + day, so results
+          do not depend on how days are scheduled across threads.
+        - Days with fewer than 7 points (SOD + 5 intraday + EOD) are set to NaN.
+        """
+        for d in prange(len(lengths)):
+            np.random.seed(base_seed + d)
+            if lengths[d] < 7:
+                out[d] = np.nan
+            else:
+                out[d] = mc_day_kernel(prices[d, :lengths[d]], sod[d], eod[d], n_sims)
+
+    # Warm up once at import so compilation is not charged to the first run
+    mc_all_days(*pad_days([np.linspace(1.0, 2.0, 16, dtype=np.float32)], [2.0]), 1, 0, np.empty(1))
+
+def monte_carlo_simulation(df, num_simulations=simulations, seed=seed):
     """
-    Runs Monte Carlo simulations in parallel for all available trading days.
-    Uses multiprocessing to speed up calculations.
+    Runs Monte Carlo simulations for all available trading days.
+    SOD is the first price at 09:00 (else the first market-hours price) and EOD the
+    first price at 17:29 (else the last market-hours price), taken in the same pass
+    as the day split.
+    Days are multi-threaded by the Numba driver when available.
+    A single PCG64 generator is created per run and seeds all random draws.
     """
-    results = []
-    df['date'] = df['timestamp'].dt.date
-    grouped_data = df.groupby('date')
+    days, price_chunks, eod = split_by_day(df)
 
-    with ProcessPoolExecutor() as executor:
-        futures = []
-        for date, data in grouped_data:
-            if date not in sod_eod:
-                continue
+    if len(days) == 0:  # No prices within market hours
+        return pd.DataFrame({'Date': days, 'realized_volatility': np.empty(0)})
 
-            sod, eod = sod_eod[date]
-            prices = data['price'].values
+    prices, lengths, sod, eod = pad_days(price_chunks, eod)
+    rng = np.random.default_rng(seed)
 
-            futures.append(executor.submit(monte_carlo_day, date, prices, sod, eod, num_simulations))
+    if NUMBA_AVAILABLE:
+        volatilities = np.empty(len(days), dtype=np.float64)
+        base_seed = rng.integers(2 ** 31)
+        mc_all_days(prices, lengths, sod, eod, num_simulations, base_seed, volatilities)
+    else:
+        volatilities = calculate_realized_volatility_all_days(prices, lengths, sod, eod,
+                                                              num_simulations, rng)
 
-        # Collect results
-        for future in futures:
-            date, volatility = future.result()
-            if volatility is not None:
-                results.append({'Date': date, 'realized_volatility': volatility})
-                print(f"Date: {date}, Realized Volatility: {volatility:.6f}")
+    # Drop days without enough prices for a simulation
+    valid = ~np.isnan(volatilities)
+    days, volatilities = days[valid], volatilities[valid]
 
-    return pd.DataFrame(results)
+    for date, volatility in zip(days, volatilities):
+        print(f"Date: {date}, Realized Volatility: {volatility:.6f}")
+
+    return pd.DataFrame({'Date': days, 'realized_volatility': volatilities})
 
 def save_results(results, filename):
     """
     Saves the final results as a CSV file with error handling.
+    Uses PyArrow's multithreaded CSV writer, which truncates any existing file.
     """
     try:
         file_path = os.path.join(output_path, filename) if output_path else filename
 
-        # Ensure file is not open in another program
-        if os.path.exists(file_path):
-            os.remove(file_path)  # Remove before writing to prevent conflicts
+        table = pa.Table.from_pandas(results, preserve_index=False)
+
+        # Write dates as YYYY-MM-DD rather than midnight timestamps
+        date_index = table.schema.get_field_index('Date')
+        table = table.set_column(date_index, 'Date', table['Date'].cast(pa.date32()))
 
-        results.to_csv(file_path, index=False)
+        # Unquoted header and platform line endings, as pandas' to_csv wrote them
+        write_options = pv.WriteOptions(quoting_header='none', eol=os.linesep)
+        pv.write_csv(table, file_path, write_options=write_options)
         logging.info(f"Results saved to {file_path}")
 
     except Exception as e:
@@ -165,16 +347,12 @@ def main():
         logging.error("Error loading data. Exiting.")
         return
 
-    # Extract SOD and EOD prices
-    asml_sod_eod = extract_sod_eod(asml_data)
-    bmw_sod_eod = extract_sod_eod(bmw_data)
-
-    # Run Monte Carlo simulations (Parallelized)
+    # Run Monte Carlo simulations
     print("\nCalculating realized volatility for ASML...\n")
-    asml_results = monte_carlo_simulation(asml_data, asml_sod_eod)
+    asml_results = monte_carlo_simulation(asml_data)
 
     print("\nCalculating realized volatility for BMW...\n")
-    bmw_results = monte_carlo_simulation(bmw_data, bmw_sod_eod)
+    bmw_results = monte_carlo_simulation(bmw_data)
 
     # Save results
     save_results(asml_results, 'asml_realized_volatility.csv')